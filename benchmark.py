@@ -0,0 +1,170 @@
+import time
+import argparse
+
+import yaml
+import numpy as np
+import torch
+
+from model import build_model
+from dataloader import Collator
+from memory_probe import measure, find_max_batch_size
+
+
+def synthetic_batches(
+    num_batches, batch_size, max_length, num_tokens, num_vocab, word_mask_prob, seed=1
+):
+    """Random `FilePathDataset`-like samples with ragged lengths, one list per batch."""
+
+    rng = np.random.RandomState(seed)
+    batches = []
+
+    for _ in range(num_batches):
+        batch = []
+        for _ in range(batch_size):
+            length = rng.randint(16, max_length + 1)
+            phonemes = torch.from_numpy(rng.randint(1, num_tokens, length))
+            words = torch.from_numpy(rng.randint(1, num_vocab, length))
+            labels = torch.from_numpy(rng.randint(1, num_tokens, length))
+            masked_index = np.flatnonzero(rng.rand(length) < word_mask_prob)
+            batch.append((phonemes, words, labels, masked_index))
+        batches.append(batch)
+
+    return batches
+
+
+def run_steps(model, batches, collate_fn):
+    """Runs one training step per batch and returns the time of each step in seconds."""
+
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    times = []
+
+    for batch in batches:
+        batch = {k: v for k, v in collate_fn(batch).items() if torch.is_tensor(v)}
+        start = time.perf_counter()
+        loss = model(**batch).loss
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        times.append(time.perf_counter() - start)
+
+    return times
+
+
+def bench_compile(config, args):
+    """Compares eager and compiled step time, with and without length buckets."""
+
+    from torch._inductor.compile_fx import compile_fx
+
+    torch._dynamo.config.automatic_dynamic_shapes = False
+    torch._dynamo.config.cache_size_limit = max(
+        torch._dynamo.config.cache_size_limit, args.steps
+    )
+
+    batches = synthetic_batches(
+        args.steps,
+        args.batch_size,
+        config["dataset_params"]["max_mel_length"],
+        config["model_params"]["vocab_size"],
+        args.num_vocab,
+        config["dataset_params"]["word_mask_prob"],
+    )
+    settings = [
+        ("eager", False, None),
+        ("compiled", True, None),
+        ("compiled + buckets", True, config["bucket_lengths"]),
+    ]
+
+    print(f"{'mode':<20}{'compiles':>10}{'first steps (s)':>18}{'step (ms)':>12}")
+
+    for name, compiled, bucket_lengths in settings:
+        torch.manual_seed(1)
+        model = build_model(config, args.num_vocab)
+        compiles = 0
+
+        def counting_backend(gm, example_inputs):
+            nonlocal compiles
+            compiles += 1
+            return compile_fx(gm, example_inputs)
+
+        if compiled:
+            torch._dynamo.reset()
+            model = torch.compile(model, backend=counting_backend)
+
+        times = run_steps(model, batches, Collator(bucket_lengths=bucket_lengths))
+
+        # steps that triggered a compilation dominate the first batches,
+        # so the steady-state time is taken over the second half
+        steady = np.median(times[len(times) // 2 :]) * 1000
+        warmup = sum(times[: len(times) // 2])
+        print(f"{name:<20}{compiles:>10}{warmup:>18.2f}{steady:>12.1f}")
+
+
+def bench_memory(config, args):
+    """Reports peak memory and throughput for each attention / checkpointing setting."""
+
+    num_layers = config["model_params"]["num_hidden_layers"]
+    seq_len = config["dataset_params"]["max_mel_length"]
+    settings = [
+        (attn_implementation, checkpoint_every)
+        for attn_implementation in ["eager", "sdpa"]
+        for checkpoint_every in [None, 2, 1]
+        if checkpoint_every is None or checkpoint_every < num_layers
+    ]
+
+    header = f"{'attention':<12}{'checkpoint':>12}{'peak (MB)':>12}{'tokens/s':>12}"
+    if args.memory_limit_gb is not None:
+        header += f"{'max batch':>12}{'max tokens':>12}"
+    print(header)
+
+    for attn_implementation, checkpoint_every in settings:
+        config["memory_params"] = {
+            "attn_implementation": attn_implementation,
+            "gradient_checkpointing": checkpoint_every is not None,
+            "checkpoint_every": checkpoint_every or 1,
+        }
+        result = measure(
+            config, args.num_vocab, args.batch_size, seq_len, device=args.device
+        )
+        checkpoint = "none" if checkpoint_every is None else f"every {checkpoint_every}"
+
+        if result is None:
+            line = f"{attn_implementation:<12}{checkpoint:>12}{'OOM':>12}{'-':>12}"
+        else:
+            line = (
+                f"{attn_implementation:<12}{checkpoint:>12}"
+                f"{result['peak_bytes'] / 2**20:>12.0f}{result['tokens_per_s']:>12.0f}"
+            )
+
+        if args.memory_limit_gb is not None:
+            batch_size, _ = find_max_batch_size(
+                config,
+                args.num_vocab,
+                args.memory_limit_gb * 2**30,
+                seq_len,
+                device=args.device,
+            )
+            line += f"{batch_size:>12}{batch_size * seq_len:>12}"
+
+        print(line, flush=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", choices=["compile", "memory"])
+    parser.add_argument("--config", default="Configs/config_yue.yml")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--num_hidden_layers", type=int, default=None)
+    parser.add_argument("--num_vocab", type=int, default=30000)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--memory_limit_gb", type=float, default=None)
+    args = parser.parse_args()
+
+    config = yaml.safe_load(open(args.config))
+    if args.num_hidden_layers is not None:
+        config["model_params"]["num_hidden_layers"] = args.num_hidden_layers
+
+    if args.mode == "compile":
+        bench_compile(config, args)
+    elif args.mode == "memory":
+        bench_memory(config, args)
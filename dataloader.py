@@ -38,6 +38,7 @@ class FilePathDataset(torch.utils.data.Dataset):
         word_mask_prob=0.15,
         phoneme_mask_prob=0.1,
         replace_prob=0.2,
+        seed=None,
     ):
 
         self.data = dataset
@@ -49,11 +50,18 @@ class FilePathDataset(torch.utils.data.Dataset):
         self.word_separator = word_separator
         self.token_mask = token_mask
         self.token_separator = token_separator
+        self.seed = seed
 
     def __len__(self):
         return len(self.data)
 
     def __getitem__(self, idx):
+        # with a seed, every sample is masked the same way on every pass (validation)
+        rng = np.random.RandomState([self.seed, idx]) if self.seed is not None else np.random
+
+        return self.mask_sample(idx, rng)
+
+    def mask_sample(self, idx, rng):
 
         phonemes = self.data[idx]["phonemes"]
         input_ids = self.data[idx]["input_ids"]
@@ -74,12 +82,12 @@ class FilePathDataset(torch.utils.data.Dataset):
                 + [token_separator_id]
             )
 
-            if np.random.rand() < self.word_mask_prob:
-                if np.random.rand() < self.replace_prob:
-                    if np.random.rand() < (self.phoneme_mask_prob / self.replace_prob):
+            if rng.rand() < self.word_mask_prob:
+                if rng.rand() < self.replace_prob:
+                    if rng.rand() < (self.phoneme_mask_prob / self.replace_prob):
                         for j in range(word2ph[i]):
                             phoneme.append(
-                                phonemes[np.random.randint(0, len(phonemes))]
+                                phonemes[rng.randint(0, len(phonemes))]
                             )  # randomized
                     else:
                         phoneme.extend(phonemes[start_idx : start_idx + word2ph[i]])
@@ -101,7 +109,7 @@ class FilePathDataset(torch.utils.data.Dataset):
         masked_idx = np.array(masked_index)
         masked_index = []
         if mel_length > self.max_mel_length:
-            random_start = np.random.randint(0, mel_length - self.max_mel_length)
+            random_start = rng.randint(0, mel_length - self.max_mel_length)
             phoneme = phoneme[random_start : random_start + self.max_mel_length]
             words = words[random_start : random_start + self.max_mel_length]
             labels = labels[random_start : random_start + self.max_mel_length]
@@ -126,11 +134,14 @@ class Collator(object):
     """
     Args:
       adaptive_batch_size (bool): if true, decrease batch size when long data comes.
+      bucket_lengths (list): if set, pad every batch to the smallest bucket that fits
+        it and only return tensors, so that `torch.compile` sees a fixed set of shapes.
     """
 
-    def __init__(self, return_wave=False):
+    def __init__(self, return_wave=False, bucket_lengths=None):
         self.text_pad_index = 0
         self.return_wave = return_wave
+        self.bucket_lengths = sorted(bucket_lengths) if bucket_lengths else None
 
     def __call__(self, batch):
         # batch[0] = wave, mel, text, f0, speakerid
@@ -143,9 +154,17 @@ class Collator(object):
 
         max_text_length = max([b[1].shape[0] for b in batch])
 
+        if self.bucket_lengths is not None:
+            max_text_length = next(
+                (l for l in self.bucket_lengths if l >= max_text_length),
+                max_text_length,
+            )
+
         words = torch.zeros((batch_size, max_text_length)).long()
         labels = torch.zeros((batch_size, max_text_length)).long()
         phonemes = torch.zeros((batch_size, max_text_length)).long()
+        attention_mask = torch.zeros((batch_size, max_text_length)).long()
+        masked_mask = torch.zeros((batch_size, max_text_length)).bool()
         input_lengths = []
         masked_indices = []
         for bid, (phoneme, word, label, masked_index) in enumerate(batch):
@@ -153,19 +172,62 @@ class Collator(object):
             words[bid, :text_size] = word
             labels[bid, :text_size] = label
             phonemes[bid, :text_size] = phoneme
+            attention_mask[bid, :text_size] = 1
+            masked_mask[bid, torch.as_tensor(masked_index, dtype=torch.long)] = True
             input_lengths.append(text_size)
             masked_indices.append(masked_index)
         output_dict = {
             "phonemes": phonemes,
             "words": words,
             "labels": labels,
-            "input_lengths": input_lengths,
-            "masked_indices": masked_indices,
+            "attention_mask": attention_mask,
+            "masked_mask": masked_mask,
         }
 
+        if self.bucket_lengths is None:
+            output_dict["input_lengths"] = input_lengths
+            output_dict["masked_indices"] = masked_indices
+
         return output_dict
 
 
+class LengthSortedBatchSampler(torch.utils.data.Sampler):
+    """
+    Groups samples of similar length into the same batch so that little compute is
+    spent on padding. The order is fixed, which makes evaluation deterministic.
+
+    Args:
+      max_batches (int): if set, only a fixed random subset of
+        `max_batches * batch_size` samples is used, so that a capped evaluation is
+        still representative of the whole split.
+    """
+
+    def __init__(self, dataset, batch_size, max_batches=None, seed=1):
+        num_samples = len(dataset)
+
+        if max_batches is not None and max_batches * batch_size < num_samples:
+            subset = np.random.RandomState(seed).choice(
+                num_samples, max_batches * batch_size, replace=False
+            )
+            subset = np.sort(subset)
+            lengths = [len(dataset.data[int(i)]["input_ids"]) for i in subset]
+        else:
+            subset = np.arange(num_samples)
+            lengths = [len(input_ids) for input_ids in dataset.data["input_ids"]]
+
+        # the number of words is a cheap proxy for the phoneme length
+        indexes = subset[np.argsort(lengths, kind="stable")[::-1]].tolist()
+        self.batches = [
+            indexes[i : i + batch_size] for i in range(0, len(indexes), batch_size)
+        ]
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+
 def build_dataloader(
     df,
     validation=False,
@@ -174,18 +236,36 @@ def build_dataloader(
     device="cpu",
     collate_config={},
     dataset_config={},
+    seed=1,
+    max_batches=None,
 ):
 
+    if validation:
+        # deterministic masking so that metrics are comparable between evaluations
+        dataset_config = {**dataset_config, "seed": seed}
+
     dataset = FilePathDataset(df, **dataset_config)
     collate_fn = Collator(**collate_config)
-    data_loader = DataLoader(
-        dataset,
-        batch_size=batch_size,
-        shuffle=(not validation),
-        num_workers=num_workers,
-        drop_last=(not validation),
-        collate_fn=collate_fn,
-        pin_memory=(device != "cpu"),
-    )
+
+    if validation:
+        data_loader = DataLoader(
+            dataset,
+            batch_sampler=LengthSortedBatchSampler(
+                dataset, batch_size, max_batches=max_batches, seed=seed
+            ),
+            num_workers=num_workers,
+            collate_fn=collate_fn,
+            pin_memory=(device != "cpu"),
+        )
+    else:
+        data_loader = DataLoader(
+            dataset,
+            batch_size=batch_size,
+            shuffle=True,
+            num_workers=num_workers,
+            drop_last=True,
+            collate_fn=collate_fn,
+            pin_memory=(device != "cpu"),
+        )
 
     return data_loader
@@ -0,0 +1,156 @@
+import os
+import sys
+import json
+import time
+import resource
+import subprocess
+
+import torch
+
+from model import build_model
+
+
+def synthetic_batch(batch_size, seq_len, num_tokens, num_vocab, word_mask_prob=0.15):
+    """A full-length batch, the worst case for a given batch size."""
+
+    return {
+        "phonemes": torch.randint(1, num_tokens, (batch_size, seq_len)),
+        "words": torch.randint(1, num_vocab, (batch_size, seq_len)),
+        "labels": torch.randint(1, num_tokens, (batch_size, seq_len)),
+        "attention_mask": torch.ones((batch_size, seq_len)).long(),
+        "masked_mask": torch.rand((batch_size, seq_len)) < word_mask_prob,
+    }
+
+
+def _peak_rss():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _run_steps(config, num_vocab, batch_size, seq_len, steps, device):
+    torch.manual_seed(1)
+    model = build_model(config, num_vocab).to(device)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-4)
+    batch = synthetic_batch(
+        batch_size, seq_len, config["model_params"]["vocab_size"], num_vocab
+    )
+    batch = {k: v.to(device) for k, v in batch.items()}
+
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+
+    elapsed = 0.0
+    # the first step allocates the optimizer states and is not timed
+    for step in range(steps + 1):
+        start = time.perf_counter()
+        with torch.autocast(
+            device_type=device.type,
+            dtype=torch.bfloat16,
+            enabled=config["mixed_precision"] == "bf16",
+        ):
+            loss = model(**batch).loss
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        if step > 0:
+            elapsed += time.perf_counter() - start
+
+    if device.type == "cuda":
+        peak = torch.cuda.max_memory_allocated(device)
+    else:
+        peak = _peak_rss()
+
+    return {
+        "batch_size": batch_size,
+        "peak_bytes": peak,
+        "tokens_per_s": batch_size * seq_len * steps / elapsed,
+    }
+
+
+def measure(config, num_vocab, batch_size, seq_len, steps=2, device="cpu"):
+    """Measures peak memory and throughput of training steps at one batch size.
+
+    On CPU every measurement runs in a fresh interpreter, so the peak resident set
+    size covers only this setting (including the model and optimizer states). On
+    CUDA the peak allocated memory is used. Returns `None` if the step runs out of
+    memory; on CPU that is a measurement process killed by a signal (the OOM killer
+    sends SIGKILL), any other failure is raised.
+    """
+
+    device = torch.device(device)
+
+    if device.type == "cuda":
+        try:
+            return _run_steps(config, num_vocab, batch_size, seq_len, steps, device)
+        except torch.cuda.OutOfMemoryError:
+            return None
+        finally:
+            torch.cuda.empty_cache()
+
+    request = [config, num_vocab, batch_size, seq_len, steps]
+    process = subprocess.run(
+        [sys.executable, "-m", "memory_probe"],
+        input=json.dumps(request),
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+
+    if process.returncode < 0:
+        return None
+    if process.returncode != 0:
+        raise RuntimeError(
+            f"Memory measurement at batch size {batch_size} failed:\n{process.stderr}"
+        )
+
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def find_max_batch_size(
+    config, num_vocab, memory_limit, seq_len, device="cpu", max_batch_size=4096
+):
+    """Finds the largest batch size whose training step fits in `memory_limit` bytes.
+
+    The batch size is doubled until a step exceeds the limit and then narrowed down
+    with a binary search. Batches are `seq_len` long, so the token budget is
+    `batch_size * seq_len`.
+
+    Returns:
+      The largest batch size that fits (0 if none does) and the list of measurements.
+    """
+
+    results = []
+
+    def fits(batch_size):
+        result = measure(config, num_vocab, batch_size, seq_len, device=device)
+        if result is not None:
+            results.append(result)
+
+        return result is not None and result["peak_bytes"] <= memory_limit
+
+    low, high = 0, 1
+    while high <= max_batch_size and fits(high):
+        low, high = high, high * 2
+
+    high = min(high, max_batch_size + 1)
+    while high - low > 1:
+        mid = (low + high) // 2
+        if fits(mid):
+            low = mid
+        else:
+            high = mid
+
+    return low, results
+
+
+if __name__ == "__main__":
+    # entry point of the per-measurement process used by `measure` on CPU
+    config, num_vocab, batch_size, seq_len, steps = json.load(sys.stdin)
+    result = _run_steps(
+        config, num_vocab, batch_size, seq_len, steps, torch.device("cpu")
+    )
+    print(json.dumps(result))
@@ -4,6 +4,7 @@ import torch.nn.functional as F
 from typing import Optional
 from dataclasses import dataclass
 from utils import length_to_mask
+from transformers import BertConfig, BertModel
 from transformers.modeling_outputs import BaseModelOutput
 
 
@@ -23,7 +24,6 @@ class MultiTaskModel(nn.Module):
         self.encoder = model
         self.mask_predictor = nn.Linear(hidden_size, num_tokens)
         self.word_predictor = nn.Linear(hidden_size, num_vocab)
-        self.criterion = nn.CrossEntropyLoss()
 
     def forward(
         self,
@@ -33,39 +33,48 @@ class MultiTaskModel(nn.Module):
         input_lengths=None,
         masked_indices=None,
         attention_mask=None,
+        masked_mask=None,
     ):
-        if input_lengths is not None:
+        if attention_mask is None and input_lengths is not None:
             text_mask = length_to_mask(torch.Tensor(input_lengths)).to(phonemes.device)
             attention_mask = (~text_mask).int()
 
+        if masked_mask is None and masked_indices is not None:
+            masked_mask = torch.zeros_like(phonemes, dtype=torch.bool)
+            for bid, _masked_indices in enumerate(masked_indices):
+                masked_mask[bid, torch.as_tensor(_masked_indices, dtype=torch.long)] = True
+
         output = self.encoder(phonemes, attention_mask=attention_mask)
         tokens_pred = self.mask_predictor(output.last_hidden_state)
         words_pred = self.word_predictor(output.last_hidden_state)
 
-        if words is not None and labels is not None and input_lengths is not None:
-            loss_vocab = 0
-            for _s2s_pred, _text_input, _text_length, _masked_indices in zip(
-                words_pred, words, input_lengths, masked_indices
-            ):
-                loss_vocab += self.criterion(
-                    _s2s_pred[:_text_length], _text_input[:_text_length]
-                )
-            loss_vocab /= words.size(0)
-
-            loss_token = 0
-            sizes = 1
-            for _s2s_pred, _text_input, _text_length, _masked_indices in zip(
-                tokens_pred, labels, input_lengths, masked_indices
-            ):
-                if len(_masked_indices) > 0:
-                    _text_input = _text_input[:_text_length][_masked_indices]
-                    loss_tmp = self.criterion(
-                        _s2s_pred[:_text_length][_masked_indices],
-                        _text_input[:_text_length],
-                    )
-                    loss_token += loss_tmp
-                    sizes += 1
-            loss_token /= sizes
+        if (
+            words is not None
+            and labels is not None
+            and attention_mask is not None
+            and masked_mask is not None
+        ):
+            # mask-based losses without data-dependent control flow, so that the
+            # loss path compiles into a single graph
+            text_mask = attention_mask.bool()
+
+            # mean over each sequence, then over the batch
+            loss_vocab = F.cross_entropy(
+                words_pred.transpose(1, 2), words, reduction="none"
+            )
+            loss_vocab = (loss_vocab * text_mask).sum(1) / text_mask.sum(1).clamp(min=1)
+            loss_vocab = loss_vocab.mean()
+
+            # mean over the masked phonemes of each sequence, then over the
+            # sequences with at least one masked phoneme (plus one)
+            masked_mask = masked_mask & text_mask
+            loss_token = F.cross_entropy(
+                tokens_pred.transpose(1, 2), labels, reduction="none"
+            )
+            loss_token = (loss_token * masked_mask).sum(1) / masked_mask.sum(1).clamp(
+                min=1
+            )
+            loss_token = loss_token.sum() / (masked_mask.any(1).sum() + 1)
 
             loss = loss_vocab + loss_token
 
@@ -87,3 +96,41 @@ class MultiTaskModel(nn.Module):
             tokens_pred=tokens_pred,
             words_pred=words_pred,
         )
+
+
+def apply_gradient_checkpointing(bert, every=1):
+    """Recomputes the activations of every `every`-th encoder layer during backward.
+
+    Uses the checkpointing built into the transformers layers, so parameter names,
+    copies of the model and `TrainingArguments(gradient_checkpointing=...)` behave
+    as usual.
+    """
+
+    bert.gradient_checkpointing_enable(
+        gradient_checkpointing_kwargs={"use_reentrant": False}
+    )
+
+    for i, layer in enumerate(bert.encoder.layer):
+        layer.gradient_checkpointing = i % every == 0
+
+
+def build_model(config, num_vocab):
+    """Builds the `MultiTaskModel` described by `model_params` and `memory_params`."""
+
+    memory_params = config["memory_params"]
+    bert = BertModel(
+        BertConfig(
+            **config["model_params"],
+            attn_implementation=memory_params["attn_implementation"],
+        )
+    )
+
+    if memory_params["gradient_checkpointing"]:
+        apply_gradient_checkpointing(bert, every=memory_params["checkpoint_every"])
+
+    return MultiTaskModel(
+        bert,
+        num_vocab=num_vocab,
+        num_tokens=config["model_params"]["vocab_size"],
+        hidden_size=config["model_params"]["hidden_size"],
+    )
@@ -1,6 +1,18 @@
+import os
 import re
+import json
+import uuid
+import sqlite3
+import logging
+from collections import OrderedDict
+from multiprocessing import util
 from text_normalize import normalize_text
 
+logger = logging.getLogger(__name__)
+
+# Split normalized text after sentence-final punctuation
+sentence_pattern = re.compile(r"[^.!?]+[.!?]*|[.!?]+")
+
 
 def split_jyutping(text):
     """Splits a string of Jyutping into a list of individual syllables and punctuation.
@@ -31,11 +43,10 @@ def is_jyutping(text):
     return re.match(r"^[a-z]+[1-6]{1}", text) is not None
 
 
-def phonemize(text, phonemizer, tokenizer):
+def _phonemize(text, phonemizer, tokenizer):
     input_ids = []
     phonemes = []
     tmp_phoneme = None
-    text = normalize_text(text)
     phoneme_text = phonemizer(text)
     tokenized_text = tokenizer.encode(phoneme_text, add_special_tokens=False)
 
@@ -73,3 +84,243 @@ def phonemize(text, phonemizer, tokenizer):
     assert len(input_ids) == len(phonemes)
 
     return {"input_ids": input_ids, "phonemes": phonemes}
+
+
+def _at_process_exit(callback):
+    # pool workers exit through os._exit, which skips atexit but runs the
+    # finalizers of the multiprocessing implementation that started them
+    util.Finalize(None, callback, exitpriority=10)
+
+    try:
+        import multiprocess.util  # used by datasets.map
+
+        multiprocess.util.Finalize(None, callback, exitpriority=10)
+    except ImportError:
+        pass
+
+
+class PhonemizeCache:
+    """
+    Size-bounded LRU cache of `phonemize` results keyed by normalized sentence.
+
+    Args:
+      maxsize (int): number of sentences kept in memory.
+      path (str): optional SQLite file shared by all workers. Entries evicted from
+        memory, or computed by another worker, are read back from it.
+      flush_every (int): number of new entries buffered before writing to disk.
+        Every process also flushes when it exits.
+      log_every (int): log the hit-rate statistics every n lookups, 0 disables it.
+      run_id (str): identifies the lookups of this cache and of its copies in
+        worker processes in the statistics stored on disk, a new id by default.
+      namespace (dict): identifies the tokenizer and phonemizer the results were
+        computed with, e.g. tokenizer name, vocabulary size and ToJyutping version.
+        Required with `path`; a store built with a different namespace is rejected
+        instead of returning stale results.
+    """
+
+    def __init__(
+        self,
+        maxsize=100000,
+        path=None,
+        flush_every=1000,
+        log_every=100000,
+        run_id=None,
+        namespace=None,
+    ):
+        if path is not None and namespace is None:
+            raise ValueError(
+                "A namespace identifying the tokenizer and phonemizer is required "
+                "with an on-disk cache"
+            )
+
+        self.maxsize = maxsize
+        self.path = path
+        self.namespace = namespace
+        self.flush_every = flush_every
+        self.log_every = log_every
+        self.run_id = run_id if run_id is not None else uuid.uuid4().hex
+        self.entries = OrderedDict()
+        self.pending = []
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._conn = None
+        self._pid = None
+        self._worker_id = None
+
+    def __getstate__(self):
+        # workers start with an empty memory cache and their own connection
+        return {
+            "maxsize": self.maxsize,
+            "path": self.path,
+            "flush_every": self.flush_every,
+            "log_every": self.log_every,
+            "run_id": self.run_id,
+            "namespace": self.namespace,
+        }
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def conn(self):
+        if self.path is None:
+            return None
+
+        # connections must not be shared with forked workers
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS phonemize (sentence TEXT PRIMARY KEY, result TEXT)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS stats (run_id TEXT, worker_id TEXT, "
+                "hits INTEGER, disk_hits INTEGER, misses INTEGER, "
+                "PRIMARY KEY (run_id, worker_id))"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            self._conn.execute(
+                "INSERT OR IGNORE INTO metadata VALUES ('namespace', ?)",
+                (json.dumps(self.namespace, sort_keys=True),),
+            )
+            self._conn.commit()
+
+            stored = json.loads(
+                self._conn.execute(
+                    "SELECT value FROM metadata WHERE key = 'namespace'"
+                ).fetchone()[0]
+            )
+            if stored != json.loads(json.dumps(self.namespace)):
+                self._conn.close()
+                self._conn = None
+                raise ValueError(
+                    f"{self.path} was built with {stored}, not {self.namespace}"
+                )
+
+            self._pid = os.getpid()
+            self._worker_id = uuid.uuid4().hex
+            _at_process_exit(self.flush)
+
+        return self._conn
+
+    def get(self, sentence):
+        result = self.entries.get(sentence)
+
+        if result is not None:
+            self.entries.move_to_end(sentence)
+            self.hits += 1
+        elif self.conn is not None:
+            row = self.conn.execute(
+                "SELECT result FROM phonemize WHERE sentence = ?", (sentence,)
+            ).fetchone()
+
+            if row is not None:
+                result = json.loads(row[0])
+                self._insert(sentence, result)
+                self.hits += 1
+                self.disk_hits += 1
+
+        if result is None:
+            self.misses += 1
+
+        lookups = self.hits + self.misses
+        if self.log_every and lookups % self.log_every == 0:
+            logger.info("phonemize cache: %s", self.stats())
+
+        return result
+
+    def put(self, sentence, result):
+        self._insert(sentence, result)
+
+        if self.path is not None:
+            self.pending.append((sentence, json.dumps(result)))
+
+            if len(self.pending) >= self.flush_every:
+                self.flush()
+
+    def flush(self):
+        """Writes the buffered entries and the counters of this process to disk."""
+
+        if self.conn is None:
+            return
+
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO phonemize VALUES (?, ?)", self.pending
+        )
+        self.conn.execute(
+            "INSERT OR REPLACE INTO stats VALUES (?, ?, ?, ?, ?)",
+            (self.run_id, self._worker_id, self.hits, self.disk_hits, self.misses),
+        )
+        self.conn.commit()
+        self.pending = []
+
+    def stats(self):
+        """Hit-rate statistics.
+
+        With an on-disk store, the counters of all processes sharing this `run_id`
+        (e.g. the workers of `dataset.map`) are summed; `size` is always the number
+        of entries in memory in this process.
+        """
+
+        hits, disk_hits, misses = self.hits, self.disk_hits, self.misses
+
+        if self.conn is not None:
+            self.flush()
+            hits, disk_hits, misses = (
+                value or 0
+                for value in self.conn.execute(
+                    "SELECT SUM(hits), SUM(disk_hits), SUM(misses) FROM stats WHERE run_id = ?",
+                    (self.run_id,),
+                ).fetchone()
+            )
+
+        lookups = hits + misses
+
+        return {
+            "hits": hits,
+            "disk_hits": disk_hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "size": len(self.entries),
+        }
+
+    def _insert(self, sentence, result):
+        self.entries[sentence] = result
+        self.entries.move_to_end(sentence)
+
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+
+def phonemize(text, phonemizer, tokenizer, cache=None):
+    """Converts text to word ids and their Jyutping.
+
+    With a `PhonemizeCache`, the normalized text is split into sentences and only
+    sentences not seen before go through the phonemizer and tokenizer.
+    """
+
+    text = normalize_text(text)
+
+    if cache is None:
+        return _phonemize(text, phonemizer, tokenizer)
+
+    input_ids = []
+    phonemes = []
+
+    for sentence in sentence_pattern.findall(text):
+        result = cache.get(sentence)
+
+        if result is None:
+            result = _phonemize(sentence, phonemizer, tokenizer)
+            cache.put(sentence, result)
+
+        input_ids.extend(result["input_ids"])
+        phonemes.extend(result["phonemes"])
+
+    return {"input_ids": input_ids, "phonemes": phonemes}
@@ -0,0 +1,342 @@
+import os
+import glob
+import json
+import shutil
+import argparse
+from multiprocessing import Pool
+
+import yaml
+import numpy as np
+import torch
+
+from dataloader import FilePathDataset, Collator
+
+# dtypes of the flat arrays stored in every shard
+ARRAYS = {
+    "phonemes": np.int16,
+    "words": np.int32,
+    "labels": np.int16,
+    "masked_mask": np.uint8,
+}
+
+_worker_state = {}
+
+
+def _init_worker(dataset, dataset_config, collate_config):
+    _worker_state["dataset"] = FilePathDataset(dataset, **dataset_config)
+    _worker_state["collate_fn"] = Collator(**collate_config)
+
+
+def _write_shard(task):
+    output_dir, copy, shard, batches, seed = task
+    dataset = _worker_state["dataset"]
+    collate_fn = _worker_state["collate_fn"]
+
+    shard_dir = os.path.join(output_dir, f"copy_{copy:03d}", f"shard_{shard:03d}")
+    os.makedirs(shard_dir, exist_ok=True)
+
+    files = {
+        name: open(os.path.join(shard_dir, f"{name}.bin"), "wb") for name in ARRAYS
+    }
+    offsets, shapes, input_lengths = [], [], []
+    offset = 0
+
+    for batch in batches:
+        # the masks of a sample only depend on (seed, copy, index)
+        samples = [
+            dataset.mask_sample(idx, np.random.RandomState([seed, copy, idx]))
+            for idx in batch
+        ]
+        output = collate_fn(samples)
+
+        for name, dtype in ARRAYS.items():
+            output[name].numpy().astype(dtype).tofile(files[name])
+
+        offsets.append(offset)
+        shapes.append(output["phonemes"].shape)
+        input_lengths.append(output["attention_mask"].sum(1).numpy())
+        offset += output["phonemes"].numel()
+
+    for f in files.values():
+        f.close()
+
+    np.savez(
+        os.path.join(shard_dir, "index.npz"),
+        offsets=np.array(offsets, dtype=np.int64),
+        shapes=np.array(shapes, dtype=np.int64).reshape(-1, 2),
+        input_lengths=np.array(input_lengths, dtype=np.int32),
+    )
+
+    return copy, shard
+
+
+def masks_metadata(
+    dataset, num_copies, batch_size, num_shards, seed, collate_config, dataset_config
+):
+    """Parameters that determine the content of a set of precomputed masks."""
+
+    metadata = {
+        "dataset_fingerprint": getattr(dataset, "_fingerprint", None),
+        "dataset_size": len(dataset),
+        "num_copies": num_copies,
+        "batch_size": batch_size,
+        "num_shards": num_shards,
+        "seed": seed,
+        "collate_config": collate_config,
+        "dataset_config": dataset_config,
+    }
+
+    # normalize through JSON so that it compares equal to the stored copy
+    return json.loads(json.dumps(metadata))
+
+
+def load_metadata(root):
+    """Returns the metadata of complete precomputed masks, `None` otherwise."""
+
+    path = os.path.join(root, "metadata.json")
+
+    if not os.path.isfile(path):
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def precompute_masks(
+    dataset,
+    output_dir,
+    num_copies=10,
+    batch_size=64,
+    num_shards=1,
+    num_proc=8,
+    seed=1,
+    collate_config={},
+    dataset_config={},
+):
+    """Writes `num_copies` differently masked and fully collated copies of `dataset`.
+
+    Every copy is shuffled, batched (dropping the last incomplete batch), masked with
+    the same logic as `FilePathDataset` and split into `num_shards` shards, which are
+    generated in parallel. Each shard stores the collated batches as flat binary
+    arrays that `StaticMaskedDataset` memory-maps.
+
+    The shards are written to a temporary directory whose `metadata.json` is written
+    last, and which is then moved to `output_dir`, so an interrupted run never leaves
+    a directory that looks complete. If `output_dir` already holds masks generated
+    with the same parameters they are reused, otherwise they are replaced.
+
+    Returns:
+      The metadata of the masks, to be checked by `StaticMaskedDataset`.
+    """
+
+    metadata = masks_metadata(
+        dataset, num_copies, batch_size, num_shards, seed, collate_config, dataset_config
+    )
+
+    if load_metadata(output_dir) == metadata:
+        print("Reusing masks in %s" % output_dir)
+        return metadata
+
+    tmp_dir = output_dir.rstrip(os.sep) + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    tasks = []
+    for copy in range(num_copies):
+        order = np.random.RandomState([seed, copy]).permutation(len(dataset))
+        batches = order[: len(order) // batch_size * batch_size].reshape(-1, batch_size)
+
+        for shard, shard_batches in enumerate(np.array_split(batches, num_shards)):
+            tasks.append((tmp_dir, copy, shard, shard_batches.tolist(), seed))
+
+    with Pool(
+        num_proc,
+        initializer=_init_worker,
+        initargs=(dataset, dataset_config, collate_config),
+    ) as pool:
+        for copy, shard in pool.imap_unordered(_write_shard, tasks):
+            print("Masked copy %d, shard %d" % (copy, shard))
+
+    with open(os.path.join(tmp_dir, "metadata.json"), "w") as f:
+        json.dump(metadata, f, indent=4)
+
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.rename(tmp_dir, output_dir)
+
+    return metadata
+
+
+class StaticMaskedDataset(torch.utils.data.Dataset):
+    """
+    Precomputed batches written by `precompute_masks`. An item is a whole collated
+    batch of copy `copy`, so the only work left to a worker is slicing the
+    memory-mapped arrays.
+
+    Args:
+      root (str): directory written by `precompute_masks`.
+      metadata (dict): if set, the masks must have been generated with these
+        parameters (as returned by `precompute_masks` or `masks_metadata`).
+    """
+
+    def __init__(self, root, metadata=None):
+        stored = load_metadata(root)
+
+        if stored is None:
+            raise ValueError(
+                f"{root} does not contain complete precomputed masks, "
+                "generate them with `python static_masking.py`"
+            )
+        if metadata is not None and stored != metadata:
+            mismatch = sorted(k for k in metadata if stored.get(k) != metadata[k])
+            raise ValueError(
+                f"Masks in {root} were generated with different parameters: "
+                f"{mismatch}, regenerate them with `python static_masking.py`"
+            )
+
+        self.root = root
+        self.copies = sorted(glob.glob(os.path.join(root, "copy_*")))
+        self.shards = [
+            sorted(glob.glob(os.path.join(copy, "shard_*"))) for copy in self.copies
+        ]
+        self.index = [
+            [dict(np.load(os.path.join(shard, "index.npz"))) for shard in shards]
+            for shards in self.shards
+        ]
+
+        # every copy has the same number of batches per shard
+        sizes = [len(index["offsets"]) for index in self.index[0]]
+        self.num_batches = sum(sizes)
+        self.shard_starts = np.cumsum([0] + sizes)
+        self._arrays = {}
+
+    def __getstate__(self):
+        # memory maps are opened again in every worker
+        return {**self.__dict__, "_arrays": {}}
+
+    @property
+    def num_copies(self):
+        return len(self.copies)
+
+    def __len__(self):
+        return self.num_copies * self.num_batches
+
+    def _open(self, copy, shard):
+        if (copy, shard) not in self._arrays:
+            shard_dir = self.shards[copy][shard]
+            self._arrays[(copy, shard)] = {
+                name: np.memmap(
+                    os.path.join(shard_dir, f"{name}.bin"), dtype=dtype, mode="r"
+                )
+                for name, dtype in ARRAYS.items()
+            }
+
+        return self._arrays[(copy, shard)]
+
+    def __getitem__(self, idx):
+        copy, idx = divmod(idx, self.num_batches)
+        shard = np.searchsorted(self.shard_starts, idx, side="right") - 1
+        idx -= self.shard_starts[shard]
+
+        index = self.index[copy][shard]
+        arrays = self._open(copy, shard)
+        offset = index["offsets"][idx]
+        shape = tuple(index["shapes"][idx])
+        size = shape[0] * shape[1]
+
+        # casting copies the slices out of the read-only memory maps
+        batch = {
+            name: torch.from_numpy(
+                arrays[name][offset : offset + size].astype(dtype).reshape(shape)
+            )
+            for name, dtype in [
+                ("phonemes", np.int64),
+                ("words", np.int64),
+                ("labels", np.int64),
+                ("masked_mask", bool),
+            ]
+        }
+        input_lengths = torch.from_numpy(index["input_lengths"][idx]).long()
+        batch["attention_mask"] = (
+            torch.arange(shape[1]).unsqueeze(0) < input_lengths.unsqueeze(1)
+        ).long()
+
+        return batch
+
+
+class StaticMaskSampler(torch.utils.data.Sampler):
+    """
+    Yields the batches of copy `epoch % num_copies` in a random order, so training
+    cycles through the precomputed copies. The epoch is set with `set_epoch`, which
+    the Trainer calls at the start of every epoch.
+    """
+
+    def __init__(self, dataset, shuffle=True, seed=1):
+        self.dataset = dataset
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.dataset.num_batches
+
+    def __iter__(self):
+        start = (self.epoch % self.dataset.num_copies) * self.dataset.num_batches
+        order = np.arange(self.dataset.num_batches)
+
+        if self.shuffle:
+            order = np.random.RandomState([self.seed, self.epoch]).permutation(order)
+
+        return iter((start + order).tolist())
+
+
+def unbatch(batch):
+    # items of `StaticMaskedDataset` are already collated batches
+    return batch[0]
+
+
+def build_static_dataloader(root, metadata=None, num_workers=1, device="cpu", seed=1):
+    dataset = StaticMaskedDataset(root, metadata=metadata)
+
+    return torch.utils.data.DataLoader(
+        dataset,
+        batch_size=1,
+        sampler=StaticMaskSampler(dataset, seed=seed),
+        num_workers=num_workers,
+        collate_fn=unbatch,
+        pin_memory=(device != "cpu"),
+    )
+
+
+if __name__ == "__main__":
+    from datasets import load_from_disk
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="Configs/config_yue.yml")
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=None,
+        help="overrides `batch_size`, e.g. with the one found by the memory probe",
+    )
+    args = parser.parse_args()
+
+    config = yaml.safe_load(open(args.config))
+    static_masking_params = config["static_masking_params"]
+    dataset = load_from_disk(config["data_folder"])
+    dataset = dataset.train_test_split(test_size=config["val_split"], seed=1)
+
+    precompute_masks(
+        dataset["train"],
+        static_masking_params["path"],
+        num_copies=static_masking_params["num_copies"],
+        batch_size=args.batch_size or config["batch_size"],
+        num_shards=static_masking_params["num_shards"],
+        num_proc=static_masking_params["num_proc"],
+        collate_config=(
+            {"bucket_lengths": config["bucket_lengths"]} if config["compile"] else {}
+        ),
+        dataset_config=config["dataset_params"],
+    )
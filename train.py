@@ -3,14 +3,15 @@ import torch
 from torch import nn
 from transformers import (
     BertTokenizer,
-    BertConfig,
-    BertModel,
     TrainingArguments,
     Trainer,
 )
-from model import MultiTaskModel
+from model import build_model
+from memory_probe import find_max_batch_size
 from datasets import load_from_disk
 from dataloader import build_dataloader
+from static_masking import masks_metadata, build_static_dataloader
+from validation import evaluate
 from utils import length_to_mask
 
 config_path = "Configs/config_yue.yml"  # you can change it to anything else
@@ -18,32 +19,113 @@ config = yaml.safe_load(open(config_path))
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+# with compile on, batches are padded to a fixed set of bucket lengths so that
+# every bucket compiles once and the graphs stay static
+collate_config = {"bucket_lengths": config["bucket_lengths"]} if config["compile"] else {}
+if config["compile"]:
+    torch._dynamo.config.automatic_dynamic_shapes = False
+
 # define tokenizer
 tokenizer = BertTokenizer.from_pretrained(config["dataset_params"]["tokenizer"])
 
 # define model
-bert_base_configuration = BertConfig(**config["model_params"])
-bert = BertModel(bert_base_configuration)
-model = MultiTaskModel(
-    bert,
-    num_vocab=len(tokenizer.get_vocab()),
-    num_tokens=config["model_params"]["vocab_size"],
-    hidden_size=config["model_params"]["hidden_size"],
-)
+model = build_model(config, num_vocab=len(tokenizer.get_vocab()))
 
 
 # define dataset
 dataset = load_from_disk(config["data_folder"])
+dataset = dataset.train_test_split(test_size=config["val_split"], seed=1)
 
 batch_size = config["batch_size"]
 
-train_loader = build_dataloader(
-    dataset,
-    batch_size=batch_size,
+if config["memory_params"]["memory_limit_gb"] is not None:
+    # largest batch of full-length sequences that fits in the memory budget
+    batch_size, results = find_max_batch_size(
+        config,
+        len(tokenizer.get_vocab()),
+        config["memory_params"]["memory_limit_gb"] * 2**30,
+        config["dataset_params"]["max_mel_length"],
+        device=device,
+    )
+    for result in results:
+        print(
+            "batch size %d: peak %.0f MB, %.0f tokens/s"
+            % (result["batch_size"], result["peak_bytes"] / 2**20, result["tokens_per_s"])
+        )
+
+    if batch_size == 0:
+        raise ValueError(
+            "No batch size fits in memory_limit_gb=%s, see the measurements above "
+            "(on CPU the peak also includes the Python and torch runtime)"
+            % config["memory_params"]["memory_limit_gb"]
+        )
+    print("Using batch size %d" % batch_size)
+
+static_masking_params = config["static_masking_params"]
+
+if static_masking_params["enabled"]:
+    # train on precomputed masked copies, cycling through one copy per epoch; they
+    # are generated offline by `python static_masking.py` and only checked here, so
+    # that no process of a distributed run writes to the shared directory
+    train_loader = build_static_dataloader(
+        static_masking_params["path"],
+        metadata=masks_metadata(
+            dataset["train"],
+            num_copies=static_masking_params["num_copies"],
+            batch_size=batch_size,
+            num_shards=static_masking_params["num_shards"],
+            seed=1,
+            collate_config=collate_config,
+            dataset_config=config["dataset_params"],
+        ),
+        num_workers=1,
+        device=device.type,
+    )
+else:
+    train_loader = build_dataloader(
+        dataset["train"],
+        batch_size=batch_size,
+        num_workers=0,
+        collate_config=collate_config,
+        dataset_config=config["dataset_params"],
+    )
+
+val_loader = build_dataloader(
+    dataset["test"],
+    validation=True,
+    batch_size=config["val_batch_size"],
     num_workers=0,
+    device=device.type,
     dataset_config=config["dataset_params"],
+    max_batches=config["val_max_batches"],
 )
 
+
+class PLBertTrainer(Trainer):
+    def get_train_dataloader(self):
+        if not static_masking_params["enabled"]:
+            return super().get_train_dataloader()
+
+        # precomputed batches are already collated, the sampler picks the copy of each epoch
+        return self.accelerator.prepare(train_loader)
+
+    def evaluate(self, eval_dataset=None, ignore_keys=None, metric_key_prefix="eval"):
+        # the default loop gathers the full word logits, use the lightweight one instead
+        metrics = evaluate(
+            self.model,
+            val_loader,
+            device=self.args.device,
+            bf16=self.args.bf16,
+        )
+        metrics = {f"{metric_key_prefix}_{k}": v for k, v in metrics.items()}
+        self.log(metrics)
+        self.control = self.callback_handler.on_evaluate(
+            self.args, self.state, self.control, metrics
+        )
+
+        return metrics
+
+
 training_args = TrainingArguments(
     output_dir=config["output_dir"],
     run_name="yue-pl-bert",
@@ -57,17 +139,22 @@ training_args = TrainingArguments(
     weight_decay=0.05,
     save_safetensors=False,
     save_strategy="epoch",
+    eval_strategy="steps",
+    eval_steps=config["val_interval"],
     lr_scheduler_type="cosine_with_min_lr",
     lr_scheduler_kwargs={"min_lr": 1.0e-7},
     bf16=True,
     remove_unused_columns=False,
+    dataloader_drop_last=True,
+    torch_compile=config["compile"],
     report_to="wandb",
 )
 
-trainer = Trainer(
+trainer = PLBertTrainer(
     model=model,
     args=training_args,
     train_dataset=train_loader.dataset,
+    eval_dataset=val_loader.dataset,
     data_collator=train_loader.collate_fn,
 )
 
@@ -0,0 +1,58 @@
+import torch
+
+
+def evaluate(model, data_loader, device="cpu", bf16=True):
+    """Runs the validation loop and returns the averaged metrics.
+
+    Args:
+      model: a `MultiTaskModel`.
+      data_loader: a loader built with `build_dataloader(..., validation=True)`.
+      device: device to run on.
+      bf16 (bool): run the forward pass under bf16 autocast.
+
+    Returns:
+      A dict with `loss`, `loss_vocab`, `loss_token`, `token_acc` (masked-phoneme
+      accuracy) and `word_acc` (word-prediction accuracy over all phonemes).
+    """
+
+    device = torch.device(device)
+    was_training = model.training
+    model.eval()
+
+    loss = loss_vocab = loss_token = 0.0
+    token_correct = token_total = word_correct = word_total = 0
+    num_batches = 0
+
+    with torch.inference_mode(), torch.autocast(
+        device_type=device.type, dtype=torch.bfloat16, enabled=bf16
+    ):
+        for batch in data_loader:
+            batch = {k: v.to(device) for k, v in batch.items() if torch.is_tensor(v)}
+            output = model(**batch)
+
+            text_mask = batch["attention_mask"].bool()
+            masked_mask = batch["masked_mask"] & text_mask
+
+            tokens_hit = output.tokens_pred.argmax(dim=-1) == batch["labels"]
+            words_hit = output.words_pred.argmax(dim=-1) == batch["words"]
+
+            token_correct += (tokens_hit & masked_mask).sum().item()
+            token_total += masked_mask.sum().item()
+            word_correct += (words_hit & text_mask).sum().item()
+            word_total += text_mask.sum().item()
+
+            loss += float(output.loss)
+            loss_vocab += float(output.loss_vocab)
+            loss_token += float(output.loss_token)
+            num_batches += 1
+
+    model.train(was_training)
+    num_batches = max(num_batches, 1)
+
+    return {
+        "loss": loss / num_batches,
+        "loss_vocab": loss_vocab / num_batches,
+        "loss_token": loss_token / num_batches,
+        "token_acc": token_correct / max(token_total, 1),
+        "word_acc": word_correct / max(word_total, 1),
+    }
@@ -0,0 +1,236 @@
+import os
+import bz2
+import re
+import hashlib
+import argparse
+import itertools
+import xml.etree.ElementTree as ET
+from functools import partial
+from collections import deque
+from multiprocessing import Pool
+
+import mwparserfromhell
+from datasets import Dataset
+
+# Link namespaces whose text is not part of the article body
+# (English and Chinese aliases used by the zh-yue wiki).
+SKIP_LINK_PREFIXES = (
+    "file:",
+    "image:",
+    "category:",
+    "media:",
+    "文件:",
+    "檔案:",
+    "档案:",
+    "圖像:",
+    "图像:",
+    "分類:",
+    "分类:",
+)
+
+# Tags whose contents are footnotes or markup rather than prose.
+SKIP_TAGS = ("ref", "references", "gallery", "math", "table", "code", "pre")
+
+# Split after sentence-final punctuation (full- and half-width) or newlines.
+sentence_pattern = re.compile(r"[^。！？!?\n]+[。！？!?]?")
+
+
+def _local_name(tag):
+    return tag.rsplit("}", 1)[-1]
+
+
+def iter_pages(dump_path):
+    """Streams `(id, title, text)` for every article in a MediaWiki `.xml.bz2` dump.
+
+    Only the main namespace is kept and redirects are skipped. Parsed elements are
+    cleared as soon as they have been read, so memory stays flat regardless of the
+    size of the dump.
+    """
+
+    with bz2.open(dump_path, "rb") as f:
+        context = ET.iterparse(f, events=("start", "end"))
+        _, root = next(context)
+
+        for event, elem in context:
+            if event != "end" or _local_name(elem.tag) != "page":
+                continue
+
+            page = {_local_name(child.tag): child for child in elem}
+            revision = page.get("revision")
+            text = None
+
+            if revision is not None:
+                for child in revision:
+                    if _local_name(child.tag) == "text":
+                        text = child.text
+                        break
+
+            if (
+                text
+                and page.get("ns") is not None
+                and page["ns"].text == "0"
+                and "redirect" not in page
+            ):
+                yield page["id"].text, page["title"].text, text
+
+            root.clear()
+
+
+def strip_markup(text):
+    """Removes wiki markup, keeping only the readable article text."""
+
+    wikicode = mwparserfromhell.parse(text)
+
+    for node in wikicode.filter_tags(
+        recursive=False, matches=lambda n: str(n.tag).strip().lower() in SKIP_TAGS
+    ):
+        try:
+            wikicode.remove(node)
+        except ValueError:
+            pass
+
+    for node in wikicode.filter_wikilinks():
+        if str(node.title).strip().lower().startswith(SKIP_LINK_PREFIXES):
+            try:
+                wikicode.remove(node)
+            except ValueError:
+                pass
+
+    return wikicode.strip_code(normalize=True, collapse=True)
+
+
+def split_sentences(text, min_chars=4, max_chars=160):
+    """Splits plain text into sentence-sized chunks.
+
+    Chunks shorter than `min_chars` are dropped (headings, list bullets), and
+    sentences longer than `max_chars` are hard-split. Every Cantonese character
+    takes about 3 phoneme positions (initial, final and separator), so the default
+    keeps most chunks within `max_mel_length: 512` once phonemized; digits expanded
+    by `normalize_text` can still make a chunk longer, which `FilePathDataset` crops.
+    """
+
+    chunks = []
+
+    for sentence in sentence_pattern.findall(text):
+        sentence = sentence.strip()
+
+        if len(sentence) < min_chars:
+            continue
+
+        for start in range(0, len(sentence), max_chars):
+            chunks.append(sentence[start : start + max_chars])
+
+    return chunks
+
+
+def process_page(page, min_chars=4, max_chars=160):
+    page_id, title, text = page
+    text = strip_markup(text)
+
+    return [
+        {"id": page_id, "title": title, "text": chunk}
+        for chunk in split_sentences(text, min_chars=min_chars, max_chars=max_chars)
+    ]
+
+
+def iter_chunks(
+    dump_path, num_proc=8, pages_per_batch=256, max_pending=4, min_chars=4, max_chars=160
+):
+    """Yields sentence chunks from a dump, stripping markup in a process pool.
+
+    Pages are handed to the pool in batches of `pages_per_batch`, and up to
+    `max_pending` batches are kept in flight, so the dump is read and parsed while
+    the workers strip the previous batches. `Pool.imap` would instead drain the
+    whole dump into its task queue; here at most `max_pending` batches of raw pages
+    are held in memory at any time. Chunks are yielded in dump order.
+    """
+
+    worker = partial(process_page, min_chars=min_chars, max_chars=max_chars)
+    pages = iter_pages(dump_path)
+    pending = deque()
+
+    with Pool(num_proc) as pool:
+        for batch in iter(lambda: list(itertools.islice(pages, pages_per_batch)), []):
+            pending.append(
+                pool.map_async(worker, batch, chunksize=max(1, len(batch) // num_proc))
+            )
+
+            # keep reading ahead while the window has room, otherwise drain the oldest batch
+            if len(pending) >= max_pending:
+                for chunks in pending.popleft().get():
+                    yield from chunks
+
+        while pending:
+            for chunks in pending.popleft().get():
+                yield from chunks
+
+
+def dump_fingerprint(dump_path, **kwargs):
+    """Identifies a dump by its path, size and modification time.
+
+    Dump files keep the same name between releases (`*-latest-*`), so the path
+    alone cannot be used as a cache key.
+    """
+
+    stat = os.stat(dump_path)
+    key = [os.path.abspath(dump_path), stat.st_size, stat.st_mtime_ns, sorted(kwargs.items())]
+
+    return hashlib.sha256(repr(key).encode()).hexdigest()[:16]
+
+
+def build_dataset(
+    dump_path,
+    num_proc=8,
+    pages_per_batch=256,
+    max_pending=4,
+    min_chars=4,
+    max_chars=160,
+    cache_dir=None,
+):
+    """Builds a `datasets.Dataset` with a `text` column from a local dump.
+
+    Rows are written to Arrow on disk as they are generated, so the returned dataset
+    is memory-mapped and can be passed straight to `dataset.map(phonemize, ...)`.
+    The result is cached by `datasets` under a fingerprint of the dump file (see
+    `dump_fingerprint`), so replacing the dump in place triggers a new ingestion.
+    """
+
+    return Dataset.from_generator(
+        iter_chunks,
+        gen_kwargs={
+            "dump_path": dump_path,
+            "num_proc": num_proc,
+            "pages_per_batch": pages_per_batch,
+            "max_pending": max_pending,
+            "min_chars": min_chars,
+            "max_chars": max_chars,
+        },
+        cache_dir=cache_dir,
+        fingerprint=dump_fingerprint(
+            dump_path, min_chars=min_chars, max_chars=max_chars
+        ),
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("dump_path", help="path to a *-pages-articles.xml.bz2 dump")
+    parser.add_argument("output_dir", help="where to save the text dataset")
+    parser.add_argument("--num_proc", type=int, default=8)
+    parser.add_argument("--pages_per_batch", type=int, default=256)
+    parser.add_argument("--max_pending", type=int, default=4)
+    parser.add_argument("--min_chars", type=int, default=4)
+    parser.add_argument("--max_chars", type=int, default=160)
+    args = parser.parse_args()
+
+    dataset = build_dataset(
+        args.dump_path,
+        num_proc=args.num_proc,
+        pages_per_batch=args.pages_per_batch,
+        max_pending=args.max_pending,
+        min_chars=args.min_chars,
+        max_chars=args.max_chars,
+    )
+    dataset.save_to_disk(args.output_dir)
+
+    print("Dataset saved to %s" % args.output_dir)